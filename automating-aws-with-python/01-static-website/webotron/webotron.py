@@ -1,112 +1,243 @@
 from __future__ import annotations
 
+import functools
+import hashlib
 import json
+import logging
 import mimetypes
+import mmap
 import os
-from pathlib import Path
-from pprint import pprint
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
+from http.client import HTTPConnection
+from pathlib import Path
 
 import boto3
+from botocore.config import Config
 import click
 from webotron import utils
-from functools import reduce
 
+log = logging.getLogger('webotron')
 session = None
 resource = None
 manifest = {}
 CHUNK_SIZE = 8388608
 transfer_config = None
+MAX_WORKERS = 16
+MAX_CONCURRENCY = 10
+CACHE_FILE = '.webotron-cache.json'
+QUICK_FP_SIZE = 65536
+etag_cache = {}
+
+PUBLIC_READ_POLICY = json.dumps({
+    "Version": "2012-10-17",
+    "Statement": [{
+        "Sid": "PublicReadGetObject",
+        "Effect": "Allow",
+        "Principal": "*",
+        "Action": ["s3:GetObject"],
+        "Resource": ["arn:aws:s3:::__BUCKET__/*"]
+    }]
+})
+
+# http.client sends request bodies in 8 KiB blocks, which keeps large PUTs CPU bound.
+# Raise the default before boto3 opens its first connection.
+HTTPConnection.__init__.__defaults__ = tuple(
+    1024 * 1024 if x == 8192 else x for x in HTTPConnection.__init__.__defaults__)
+
+
+def _list_prefix(bucket, prefix):
+    listing = {}
+    paginator = resource.meta.client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': 1000}):
+        listing.update((obj['Key'], (obj['ETag'], obj['Size'])) for obj in page.get('Contents', ()))
+    return listing
 
 
 def load_manifest(bucket):
+    # list the top level with a delimiter, then list each top level prefix concurrently
+    prefixes = []
     paginator = resource.meta.client.get_paginator('list_objects_v2')
-    for page in paginator.paginate(Bucket=bucket):
-        for obj in page.get('Contents', []):
-            manifest[obj['Key']] = obj['ETag']
-    pprint(manifest)
+    for page in paginator.paginate(Bucket=bucket, Delimiter='/', PaginationConfig={'PageSize': 1000}):
+        manifest.update((obj['Key'], (obj['ETag'], obj['Size'])) for obj in page.get('Contents', ()))
+        prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', ()))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        for listing in pool.map(functools.partial(_list_prefix, bucket), prefixes):
+            manifest.update(listing)
+
+
+def load_etag_cache(root):
+    try:
+        with open(os.path.join(root, CACHE_FILE)) as f:
+            etag_cache.update(json.load(f))
+    except (OSError, ValueError):
+        pass
 
 
-def hash_data(data):
+def save_etag_cache(root):
+    # write a temp file and rename it over the cache so a failed write never leaves half a file
+    cache_path = os.path.join(root, CACHE_FILE)
+    tmp_path = f"{cache_path}.tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(etag_cache, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print("Could not save the etag cache:", e)
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _file_md5(f):
+    # hashlib.file_digest (3.11+) loops in C over a reused buffer
+    if hasattr(hashlib, 'file_digest'):
+        return hashlib.file_digest(f, 'md5')
     hash = md5()
-    hash.update(data)
+    buf = bytearray(2 ** 18)
+    view = memoryview(buf)
+    while True:
+        size = f.readinto(buf)
+        if not size:
+            break
+        hash.update(view[:size])
     return hash
 
 
+def _mmap_etag(fd):
+    # hash the mapped pages directly instead of copying each chunk into a bytes object
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    hash = md5()
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+        size = len(mm)
+        for start in range(0, size, CHUNK_SIZE):
+            hash.update(md5(view[start:start + CHUNK_SIZE]).digest())
+    return f'"{hash.hexdigest()}-{-(-size // CHUNK_SIZE)}"'
+
+
 def gen_etag(file):
-    hashes = []
     with open(file, 'rb') as f:
-        while True:
-            data = f.read(CHUNK_SIZE)
-            if not data:
-                break
-            hashes.append(hash_data(data))
-    if not hashes:
-        print("Does it get here for anyone??")
-        return
-    elif len(hashes) == 1:
-        return f'"{hashes[0].hexdigest()}"'
-    else:
-        hash = hash_data(reduce(lambda x, y: x + y, (h.digest() for h in hashes)))
-        return f'"{hash.hexdigest()}-{len(hashes)}"'
-
+        size = os.fstat(f.fileno()).st_size
+        # s3transfer switches to multipart at size >= multipart_threshold (CHUNK_SIZE)
+        if size < CHUNK_SIZE:
+            return f'"{_file_md5(f).hexdigest()}"'
+        return _mmap_etag(f.fileno())
 
 
-def _upload_object_to_s3(object: str, bucket: str, object_type: str, *args, **kwargs) -> None:
+def _upload_object_to_s3(object: str, bucket_obj, object_type: str, *args, **kwargs) -> None:
     try:
         if object_type == "file":
-            resource.Bucket(bucket).upload_file(
-                Filename=object, Key=os.path.basename(object), *args, **kwargs)
+            bucket_obj.upload_file(
+                Filename=object, Key=os.path.basename(object), Config=transfer_config, *args, **kwargs)
         else:
             for dirs, subdir, files in os.walk(object):
                 for file in files:
                     full_file_name = os.path.join(dirs, file)
                     s3_file_name = os.path.join(os.path.basename(dirs), file)
-                    resource.Bucket(bucket).upload_file(
-                        Filename=full_file_name, Key=s3_file_name)
+                    bucket_obj.upload_file(
+                        Filename=full_file_name, Key=s3_file_name, Config=transfer_config)
     except Exception as e:
         raise e
 
 
-def _upload_object_when_key_available(bucket: str, object: str, key: str) -> None:
-    print(f"Trying to upload {object} and key value is {key}")
+@functools.lru_cache(maxsize=64)
+def _content_type(ext: str) -> str:
+    return mimetypes.types_map.get(ext) or mimetypes.guess_type('x' + ext)[0] or 'text/plain'
+
+
+def _etag_part_count(etag):
+    """Returns the number of parts encoded in an S3 ETag, 0 for a single-part upload"""
+    _, _, parts = etag.strip('"').partition('-')
+    return int(parts) if parts else 0
+
+
+def _local_part_count(size):
+    """Returns the part count gen_etag would encode for a file of this size"""
+    return 0 if size < CHUNK_SIZE else -(-size // CHUNK_SIZE)
+
+
+def _quick_fp(file, size):
+    """Returns a crc32 of the first and last 64 KiB of file, a cheap check that it changed"""
+    with open(file, 'rb', buffering=0) as f:
+        head = f.read(QUICK_FP_SIZE)
+        f.seek(max(0, size - QUICK_FP_SIZE))
+        tail = f.read(QUICK_FP_SIZE)
+    return zlib.crc32(head) << 32 | zlib.crc32(tail)
+
+
+def cached_etag(file, key, stat):
+    """Returns the etag of file, hashing it only if its contents changed since the last sync.
+    Entries are keyed by the s3 key so the cache survives moving the synced tree."""
+    quick = _quick_fp(file, stat.st_size)
+    entry = etag_cache.get(key)
+    # a quick fingerprint mismatch means the contents changed even if size and mtime did not
+    if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns] and entry[3:] == [quick]:
+        return entry[2]
+    etag = gen_etag(file)
+    etag_cache[key] = [stat.st_size, stat.st_mtime_ns, etag, quick]
+    return etag
+
+
+def _upload_object_when_key_available(bucket_obj, object: str, key: str) -> None:
+    log.debug("Trying to upload %s and key value is %s", object, key)
     try:
-        content_type = mimetypes.guess_type(key)[0] or 'text/plain'
-        etag = gen_etag(object)
-        print(f"The etag generated fpr the {key} is {etag}")
-        if manifest.get(key, "") == etag:
-            print(f"Skipping the key {key} since the etags match")
-            return
-        resource.Bucket(bucket).upload_file(Filename=object, Key=key,
-                                            ExtraArgs={"ContentType": content_type},
-                                            Config=transfer_config)
+        content_type = _content_type(os.path.splitext(key)[1].lower())
+        stat = os.stat(object)
+        remote = manifest.get(key)
+        # a size or part count mismatch means the etags can never match, no need to hash it
+        if (remote and remote[1] == stat.st_size
+                and _etag_part_count(remote[0]) == _local_part_count(stat.st_size)):
+            etag = cached_etag(object, key, stat)
+            log.debug("The etag generated for the %s is %s", key, etag)
+            if remote[0] == etag:
+                log.info("Skipping the key %s since the etags match", key)
+                return
+        bucket_obj.upload_file(Filename=object, Key=key,
+                               ExtraArgs={"ContentType": content_type},
+                               Config=transfer_config)
+        log.info("Uploaded %s", key)
     except Exception as e:
         raise e
 
 
+@functools.lru_cache(maxsize=32)
 def get_region_name(bucket):
-    bucket_location =  resource.meta.client.get_bucket_location(Bucket=resource.Bucket(bucket).name)
+    bucket_location = resource.meta.client.get_bucket_location(Bucket=bucket)
     return bucket_location["LocationConstraint"] or 'us-east-1'
 
 
 def get_bucket_url(bucket):
     """Get the website URL for this bucket."""
-    return f"http://{resource.Bucket(bucket).name}.{utils.get_endpoint(get_region_name(bucket))}"
+    return f"http://{bucket}.{utils.get_endpoint(get_region_name(bucket))}"
 
 
 @click.group()
 @click.option('--profile', default=None)
 def cli(profile):
     "Uploads websites to AWS"
-    global resource, session
+    global resource, session, transfer_config
     session_cfg = {}
     if profile:
         session_cfg['profile_name'] = profile
+    # progress lines go to stdout alongside the rest of the command output, as print did
+    logging.basicConfig(format='%(message)s', stream=sys.stdout)
+    log.setLevel(logging.INFO)
     session = boto3.Session(**session_cfg)
-    resource = session.resource("s3")
+    # load the mime tables up front rather than lazily from the upload threads
+    mimetypes.init()
+    # every sync-dir worker can have MAX_CONCURRENCY part uploads in flight,
+    # size the pool so urllib3 never has to discard connections
+    resource = session.resource("s3", config=Config(max_pool_connections=MAX_WORKERS * MAX_CONCURRENCY))
     transfer_config = boto3.s3.transfer.TransferConfig(
-        multipart_chunksize = CHUNK_SIZE,
-        multipart_threshold = CHUNK_SIZE
+        multipart_chunksize=CHUNK_SIZE,
+        multipart_threshold=CHUNK_SIZE,
+        io_chunksize=1024 * 1024,
+        max_concurrency=MAX_CONCURRENCY,
+        use_threads=True
     )
 
 
@@ -134,20 +265,8 @@ def enable_website_on_bucket(bucket: str) -> None:
 def make_bucket_public(bucket: str) -> None:
     "Makes a bucket public by attaching a policy object to it"
     try:
-        policy = {
-            "Version": "2012-10-17",
-            "Statement": [{
-                "Sid": "PublicReadGetObject",
-                "Effect": "Allow",
-                "Principal": "*",
-                "Action": ["s3:GetObject"],
-                "Resource": [f"arn:aws:s3:::{bucket}/*"
-                             ]
-            }
-            ]
-        }
         policy_obj = resource.Bucket(bucket).Policy()
-        policy_obj.put(Policy=json.dumps(policy))
+        policy_obj.put(Policy=PUBLIC_READ_POLICY.replace("__BUCKET__", bucket))
     except Exception as e:
         print("Something went wrong while updating the bucket policy: ", e)
 
@@ -189,11 +308,12 @@ def upload_object_to_bucket(bucket: str, object: str, object_type: str):
         if not os.path.isdir(object):
             raise NotADirectoryError(f"The object {object} is not a directory")
     try:
+        bucket_obj = resource.Bucket(bucket)
         if object_type == "file":
-            _upload_object_to_s3(object, bucket, object_type, ExtraArgs={
+            _upload_object_to_s3(object, bucket_obj, object_type, ExtraArgs={
                                  "ContentType": 'text/html'})
         else:
-            _upload_object_to_s3(object, bucket, object_type)
+            _upload_object_to_s3(object, bucket_obj, object_type)
     except Exception as e:
         print("Something went wrong in uploading objects to s3:", e)
 
@@ -215,20 +335,37 @@ def list_buckets() -> None:
 def sync_dir(bucket: str, pathname: str) -> None:
     "Sync contents of pathname to bucket... very similar to the other command which uploads a file/dir to s3"
     load_manifest(bucket)
-    root = Path(pathname).expanduser().resolve()
-
-    def handle_dir(target):
-        for p in target.iterdir():
-            if p.is_dir():
-                handle_dir(p)
-            if p.is_file():
-                try:
-                    object = str(p.resolve())
-                    key = str(p.relative_to(root))
-                    _upload_object_when_key_available(bucket, object, key)
-                except Exception as e:
-                    print(f"Could not upload {p}:", e)
-    handle_dir(root)
+    root = str(Path(pathname).expanduser().resolve())
+    root_prefix = os.path.join(root, '')
+    cache_path = os.path.join(root, CACHE_FILE)
+    load_etag_cache(root)
+    bucket_obj = resource.Bucket(bucket)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = {}
+        # scandir's DirEntry answers is_dir/is_file from the dirent type without another stat.
+        # Symlinked directories are followed; each directory carries the (st_dev, st_ino) of
+        # its ancestors so a link back up the tree is not walked forever.
+        root_stat = os.stat(root)
+        stack = [(root, frozenset([(root_stat.st_dev, root_stat.st_ino)]))]
+        while stack:
+            target, ancestors = stack.pop()
+            with os.scandir(target) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        dir_stat = entry.stat()
+                        dir_id = (dir_stat.st_dev, dir_stat.st_ino)
+                        if dir_id not in ancestors:
+                            stack.append((entry.path, ancestors | {dir_id}))
+                    elif entry.is_file() and entry.path != cache_path:
+                        future = pool.submit(_upload_object_when_key_available,
+                                             bucket_obj, entry.path, entry.path[len(root_prefix):])
+                        futures[future] = entry.path
+        for future, p in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Could not upload {p}:", e)
+    save_etag_cache(root)
     print(get_bucket_url(bucket))
 
 if __name__ == "__main__":